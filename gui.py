@@ -5,16 +5,91 @@ from pathlib import Path
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QPushButton, QLabel, QFileDialog, 
                             QComboBox, QScrollArea, QFrame, QGridLayout, 
-                            QMessageBox, QSpacerItem, QSizePolicy, QCheckBox)
-from PyQt6.QtCore import Qt, QSize, QMimeData
-from PyQt6.QtGui import (QPixmap, QImage, QPalette, QColor, QDragEnterEvent, 
-                        QDropEvent, QKeySequence)
+                            QMessageBox, QSpacerItem, QSizePolicy, QCheckBox,
+                            QProgressBar)
+from PyQt6.QtCore import (Qt, QSize, QMimeData, QObject, QThread, QRunnable,
+                          QThreadPool, pyqtSignal, pyqtSlot)
+from PyQt6.QtGui import (QPixmap, QImage, QImageReader, QPalette, QColor, 
+                        QDragEnterEvent, QDropEvent, QKeySequence)
 import img_boxer
 from PIL import Image
-from PIL.ImageQt import ImageQt
 import io
-import mimetypes
-import tempfile
+import os
+import functools
+import numpy as np
+
+# Size of the thumbnails in the selection preview grid
+PREVIEW_SIZE = 200
+# Number of decoded preview thumbnails kept in memory
+THUMBNAIL_CACHE_SIZE = 512
+
+# Extensions accepted without reading the file
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp', '.tif', '.tiff'}
+
+@functools.lru_cache(maxsize=4096)
+def _sniff_image(path, mtime_ns):
+    """Check a file's magic bytes for a supported image format.
+
+    BMP also requires its reserved header fields to be zero, so text files
+    that merely start with "BM" are rejected.
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(12)
+    except OSError:
+        return False
+    return (header.startswith(b'\xff\xd8\xff')
+            or header.startswith(b'\x89PNG\r\n\x1a\n')
+            or header[:6] in (b'GIF87a', b'GIF89a')
+            or (header.startswith(b'BM') and header[6:10] == b'\0\0\0\0')
+            or header[:4] in (b'II*\0', b'MM\0*')
+            or (header[:4] == b'RIFF' and header[8:12] == b'WEBP'))
+
+def is_valid_image(file_path):
+    """Return True if file_path looks like an image, by extension or magic bytes."""
+    if not file_path:
+        return False
+    if os.path.splitext(file_path)[1].lower() in IMAGE_EXTENSIONS:
+        return True
+    try:
+        mtime_ns = os.stat(file_path).st_mtime_ns
+    except OSError:
+        return False
+    return _sniff_image(file_path, mtime_ns)
+
+def qimage_to_pil(image):
+    """Convert a QImage to an RGB PIL image in memory."""
+    image = image.convertToFormat(QImage.Format.Format_RGBA8888)
+    width, height = image.width(), image.height()
+    ptr = image.constBits()
+    ptr.setsize(image.sizeInBytes())
+    # Rows may be padded, so slice each scanline down to width * 4 bytes
+    arr = np.frombuffer(ptr, dtype=np.uint8).reshape(height, image.bytesPerLine())
+    arr = arr[:, :width * 4].reshape(height, width, 4)
+    return Image.fromarray(arr).convert('RGB')
+
+def pil_to_qimage(image):
+    """Convert a PIL image to a QImage that owns its pixel data."""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    width, height = image.size
+    buf = image.tobytes('raw', 'RGB')
+    # QImage only wraps buf, so copy before buf goes out of scope
+    return QImage(buf, width, height, width * 3, QImage.Format.Format_RGB888).copy()
+
+def pil_thumbnail(image, max_size):
+    """Downscale a PIL image to fit within max_size x max_size for previews.
+
+    LANCZOS is reserved for the final mosaic; at thumbnail size BOX (for
+    large reductions) or BILINEAR look the same and are much cheaper.
+    """
+    width, height = image.size
+    scale = min(max_size / width, max_size / height)
+    if scale >= 1:
+        return image
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    resample = Image.Resampling.BOX if scale < 1 / 8 else Image.Resampling.BILINEAR
+    return image.resize(size, resample)
 
 class DropArea(QLabel):
     def __init__(self, parent=None):
@@ -78,20 +153,85 @@ class DropArea(QLabel):
                     file_paths.append(path)
             
             if file_paths:
-                self.parent().add_files(file_paths)
+                self.parent().add_paths(file_paths)
         
         elif mime_data.hasImage():
             # Handle image data drops
             image = QImage(mime_data.imageData())
             if not image.isNull():
-                # Save the image to a temporary file
-                temp_file = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
-                image.save(temp_file.name, 'PNG')
-                self.parent().add_files([temp_file.name])
+                self.parent().add_images([qimage_to_pil(image)])
 
     def is_valid_image(self, file_path):
-        mime_type, _ = mimetypes.guess_type(file_path)
-        return mime_type and mime_type.startswith('image/')
+        return is_valid_image(file_path)
+
+class MosaicWorker(QObject):
+    """Builds the mosaic off the GUI thread and emits the resulting PIL image.
+
+    Results carry the selection generation the worker was started for, so
+    the GUI can drop them if the selection changed in the meantime.
+    """
+    finished = pyqtSignal(int, object)
+    error = pyqtSignal(int, str)
+
+    def __init__(self, generation, items, target_ratio, crop_mode):
+        super().__init__()
+        self.generation = generation
+        self.items = items
+        self.target_ratio = target_ratio
+        self.crop_mode = crop_mode
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            mosaic = None
+            if img_boxer.pyvips is not None and all(isinstance(item, str) for item in self.items):
+                # Let libvips decode, resize and join the files directly. This
+                # is best effort: fall back to Pillow for anything this libvips
+                # build can't load (e.g. BMP without the magick loader)
+                try:
+                    mosaic = img_boxer.create_image_mosaic_vips(
+                        self.items,
+                        self.target_ratio,
+                        self.crop_mode
+                    )
+                except img_boxer.pyvips.Error:
+                    mosaic = None
+            if mosaic is None:
+                # Create the mosaic, loading any files through the tile cache
+                mosaic = img_boxer.create_image_mosaic(
+                    self.items, 
+                    self.target_ratio, 
+                    self.crop_mode
+                )
+            self.finished.emit(self.generation, mosaic)
+        except Exception as e:
+            self.error.emit(self.generation, str(e))
+
+class ThumbnailSignals(QObject):
+    # generation, grid index, cache key, thumbnail
+    loaded = pyqtSignal(int, int, object, QImage)
+
+class ThumbnailLoader(QRunnable):
+    """Decodes a preview thumbnail on a QThreadPool thread."""
+
+    def __init__(self, generation, idx, path, cache_key):
+        super().__init__()
+        self.signals = ThumbnailSignals()
+        self.generation = generation
+        self.idx = idx
+        self.path = path
+        self.cache_key = cache_key
+
+    def run(self):
+        # Ask the decoder for a scaled image so JPEGs shrink while decoding
+        reader = QImageReader(self.path)
+        size = reader.size()
+        if size.isValid():
+            reader.setScaledSize(size.scaled(
+                PREVIEW_SIZE, PREVIEW_SIZE, Qt.AspectRatioMode.KeepAspectRatio
+            ))
+        image = reader.read()
+        self.signals.loaded.emit(self.generation, self.idx, self.cache_key, image)
 
 class ImageBoxerGUI(QMainWindow):
     def __init__(self):
@@ -100,15 +240,27 @@ class ImageBoxerGUI(QMainWindow):
         self.setMinimumSize(1000, 600)
         
         # Initialize variables
-        self.selected_files = []
+        self.selected_items = []
+        self._selected_set = set()
+        self.selection_generation = 0
         self.processed_images = []
         self.final_mosaic = None
+        self.mosaic_thread = None
+        self.mosaic_worker = None
+        self.thumbnail_pool = QThreadPool(self)
+        self.thumbnail_cache = {}
+        self.preview_generation = 0
+        self.preview_labels = {}
+        # Parse the ratios once so process_images can use the floats directly
         self.aspect_ratios = {
-            "16:9 (Widescreen)": "16:9",
-            "4:3 (Standard)": "4:3",
-            "1:1 (Square)": "1:1",
-            "2:1 (Ultrawide)": "2:1",
-            "3:2 (Classic Photo)": "3:2"
+            label: img_boxer.parse_aspect_ratio(ratio)
+            for label, ratio in {
+                "16:9 (Widescreen)": "16:9",
+                "4:3 (Standard)": "4:3",
+                "1:1 (Square)": "1:1",
+                "2:1 (Ultrawide)": "2:1",
+                "3:2 (Classic Photo)": "3:2"
+            }.items()
         }
         
         # Set up the main widget and layout
@@ -189,10 +341,7 @@ class ImageBoxerGUI(QMainWindow):
         if mime_data.hasImage():
             image = QImage(mime_data.imageData())
             if not image.isNull():
-                # Save the image to a temporary file
-                temp_file = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
-                image.save(temp_file.name, 'PNG')
-                self.add_files([temp_file.name])
+                self.add_images([qimage_to_pil(image)])
         elif mime_data.hasUrls():
             file_paths = []
             for url in mime_data.urls():
@@ -200,21 +349,30 @@ class ImageBoxerGUI(QMainWindow):
                 if self.is_valid_image(path):
                     file_paths.append(path)
             if file_paths:
-                self.add_files(file_paths)
+                self.add_paths(file_paths)
 
     def is_valid_image(self, file_path):
-        mime_type, _ = mimetypes.guess_type(file_path)
-        return mime_type and mime_type.startswith('image/')
+        return is_valid_image(file_path)
 
-    def add_files(self, file_paths):
+    def add_paths(self, file_paths):
         """Add new files to the selection and update preview."""
-        # Add new files to the existing selection
-        self.selected_files.extend(file_paths)
-        # Remove duplicates while preserving order
-        self.selected_files = list(dict.fromkeys(self.selected_files))
+        # Add new files to the existing selection, skipping duplicates
+        new_paths = list(dict.fromkeys(p for p in file_paths if p not in self._selected_set))
+        self._selected_set.update(new_paths)
+        self.selected_items.extend(new_paths)
+        self.selection_changed()
+
+    def add_images(self, images):
+        """Add in-memory PIL images (pasted or dropped) to the selection."""
+        self.selected_items.extend(images)
+        self.selection_changed()
+
+    def selection_changed(self):
+        # Invalidate any mosaic still being built for the old selection
+        self.selection_generation += 1
         self.update_preview()
-        # Hide drop area if we have files
-        self.drop_area.setVisible(not self.selected_files)
+        # Hide drop area if we have images
+        self.drop_area.setVisible(not self.selected_items)
 
     def create_control_panel(self):
         control_frame = QFrame()
@@ -255,6 +413,13 @@ class ImageBoxerGUI(QMainWindow):
         self.process_btn.clicked.connect(self.process_images)
         layout.addWidget(self.process_btn)
         
+        # Busy indicator shown while the mosaic is being built
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.setMaximumWidth(120)
+        self.progress_bar.setVisible(False)
+        layout.addWidget(self.progress_bar)
+        
         # Save button
         self.save_btn = QPushButton("Save Mosaic")
         self.save_btn.clicked.connect(self.save_mosaic)
@@ -269,7 +434,9 @@ class ImageBoxerGUI(QMainWindow):
 
     def clear_files(self):
         """Clear all selected files and reset the interface."""
-        self.selected_files = []
+        self.selected_items = []
+        self._selected_set = set()
+        self.selection_generation += 1
         self.processed_images = []
         self.final_mosaic = None
         self.update_preview()
@@ -300,66 +467,143 @@ class ImageBoxerGUI(QMainWindow):
             "Image Files (*.png *.jpg *.jpeg *.bmp *.gif)"
         )
         if files:
-            self.add_files(files)
+            self.add_paths(files)
+
+    def clear_preview(self):
+        """Remove every widget from the preview grid."""
+        # Drop thumbnails still queued for the previous preview
+        self.thumbnail_pool.clear()
+        self.preview_generation += 1
+        self.preview_labels = {}
+        
+        # Drain the layout and delete the widgets in one go on the next event
+        # loop pass, rather than reparenting (and relaying out) each one
+        while self.preview_layout.count():
+            widget = self.preview_layout.takeAt(0).widget()
+            if widget is not None:
+                widget.hide()
+                widget.deleteLater()
 
     def update_preview(self):
-        # Clear existing preview
-        for i in reversed(range(self.preview_layout.count())): 
-            self.preview_layout.itemAt(i).widget().setParent(None)
+        # Clear existing preview, repainting only once the grid is rebuilt
+        self.preview_widget.setUpdatesEnabled(False)
+        self.clear_preview()
         
-        # Add images to preview grid
-        for idx, file_path in enumerate(self.selected_files):
+        # Add images to preview grid; files are decoded in the thread pool in
+        # grid order, so the visible top rows fill in first
+        for idx, item in enumerate(self.selected_items):
             try:
-                pixmap = QPixmap(file_path)
                 label = QLabel()
-                scaled_pixmap = pixmap.scaled(
-                    200, 200,
-                    Qt.AspectRatioMode.KeepAspectRatio,
-                    Qt.TransformationMode.SmoothTransformation
-                )
-                label.setPixmap(scaled_pixmap)
+                label.setFixedSize(PREVIEW_SIZE, PREVIEW_SIZE)
                 label.setAlignment(Qt.AlignmentFlag.AlignCenter)
                 
+                if isinstance(item, str):
+                    cache_key = (item, os.stat(item).st_mtime_ns)
+                    thumbnail = self.thumbnail_cache.get(cache_key)
+                    if thumbnail is not None:
+                        label.setPixmap(QPixmap.fromImage(thumbnail))
+                    else:
+                        # Grey placeholder until the thumbnail arrives
+                        label.setStyleSheet("background-color: #e0e0e0;")
+                        self.preview_labels[idx] = label
+                        loader = ThumbnailLoader(self.preview_generation, idx, item, cache_key)
+                        loader.signals.loaded.connect(self.on_thumbnail_loaded)
+                        self.thumbnail_pool.start(loader)
+                else:
+                    thumbnail = pil_thumbnail(item, PREVIEW_SIZE)
+                    label.setPixmap(QPixmap.fromImage(pil_to_qimage(thumbnail)))
+                
                 row = idx // 4
                 col = idx % 4
                 self.preview_layout.addWidget(label, row, col)
                 
             except Exception as e:
-                print(f"Error loading preview for {file_path}: {str(e)}")
+                print(f"Error loading preview for {item}: {str(e)}")
+        
+        self.preview_widget.setUpdatesEnabled(True)
+
+    def on_thumbnail_loaded(self, generation, idx, cache_key, thumbnail):
+        """Show a thumbnail decoded by a ThumbnailLoader."""
+        if thumbnail.isNull():
+            print(f"Error loading preview for {cache_key[0]}")
+            return
+        
+        self.thumbnail_cache[cache_key] = thumbnail
+        if len(self.thumbnail_cache) > THUMBNAIL_CACHE_SIZE:
+            # Evict the oldest entry
+            del self.thumbnail_cache[next(iter(self.thumbnail_cache))]
+        
+        # Ignore thumbnails for a preview that has since been rebuilt
+        if generation != self.preview_generation:
+            return
+        label = self.preview_labels.pop(idx, None)
+        if label is not None:
+            label.setStyleSheet("")
+            label.setPixmap(QPixmap.fromImage(thumbnail))
 
     def process_images(self):
-        if not self.selected_files:
+        if not self.selected_items:
             QMessageBox.warning(self, "Warning", "Please select images first!")
             return
         
-        try:
-            # Get selected aspect ratio
-            ratio_text = self.aspect_ratios[self.aspect_combo.currentText()]
-            target_ratio = img_boxer.parse_aspect_ratio(ratio_text)
-            
-            # Load all images
-            images = []
-            for file_path in self.selected_files:
-                with Image.open(file_path) as img:
-                    if img.mode != 'RGB':
-                        img = img.convert('RGB')
-                    images.append(img.copy())
-            
-            # Create the mosaic
-            self.final_mosaic = img_boxer.create_image_mosaic(
-                images, 
-                target_ratio, 
-                self.crop_checkbox.isChecked()
-            )
-            
-            # Show the mosaic preview
-            self.show_mosaic_preview()
-            
-            # Enable save button
-            self.save_btn.setEnabled(True)
-            
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Error processing images: {str(e)}")
+        # Get selected aspect ratio
+        target_ratio = self.aspect_ratios[self.aspect_combo.currentText()]
+        
+        # Build the mosaic on a worker thread so the GUI stays responsive
+        self.mosaic_thread = QThread(self)
+        self.mosaic_worker = MosaicWorker(
+            self.selection_generation,
+            list(self.selected_items),
+            target_ratio,
+            self.crop_checkbox.isChecked()
+        )
+        self.mosaic_worker.moveToThread(self.mosaic_thread)
+        self.mosaic_thread.started.connect(self.mosaic_worker.run)
+        self.mosaic_worker.finished.connect(self.on_mosaic_ready)
+        self.mosaic_worker.error.connect(self.on_mosaic_error)
+        self.mosaic_worker.finished.connect(self.mosaic_thread.quit)
+        self.mosaic_worker.error.connect(self.mosaic_thread.quit)
+        self.mosaic_thread.finished.connect(self.on_mosaic_thread_finished)
+        
+        self.process_btn.setEnabled(False)
+        self.progress_bar.setVisible(True)
+        self.mosaic_thread.start()
+
+    def on_mosaic_ready(self, generation, mosaic):
+        """Receive the finished mosaic from the worker thread."""
+        # Ignore mosaics of a selection that has since been changed or cleared
+        if generation != self.selection_generation:
+            return
+        self.final_mosaic = mosaic
+        
+        # Show the mosaic preview
+        self.show_mosaic_preview()
+        
+        # Enable save button
+        self.save_btn.setEnabled(True)
+
+    def on_mosaic_error(self, generation, message):
+        if generation != self.selection_generation:
+            return
+        QMessageBox.critical(self, "Error", f"Error processing images: {message}")
+
+    def on_mosaic_thread_finished(self):
+        """Clean up the worker thread and restore the controls."""
+        self.mosaic_worker.deleteLater()
+        self.mosaic_thread.deleteLater()
+        self.mosaic_worker = None
+        self.mosaic_thread = None
+        self.process_btn.setEnabled(True)
+        self.progress_bar.setVisible(False)
+
+    def closeEvent(self, event):
+        # Let running workers finish before their threads are destroyed
+        self.thumbnail_pool.clear()
+        self.thumbnail_pool.waitForDone()
+        if self.mosaic_thread is not None:
+            self.mosaic_thread.quit()
+            self.mosaic_thread.wait()
+        super().closeEvent(event)
 
     def show_mosaic_preview(self):
         """Show the final mosaic in the preview area."""
@@ -367,12 +611,11 @@ class ImageBoxerGUI(QMainWindow):
             return
             
         # Clear existing preview
-        for i in reversed(range(self.preview_layout.count())): 
-            self.preview_layout.itemAt(i).widget().setParent(None)
+        self.preview_widget.setUpdatesEnabled(False)
+        self.clear_preview()
         
         # Convert PIL image to QPixmap
-        qimg = ImageQt(self.final_mosaic)
-        pixmap = QPixmap.fromImage(qimg)
+        pixmap = QPixmap.fromImage(pil_to_qimage(self.final_mosaic))
         
         # Create label and scale the preview
         label = QLabel()
@@ -386,6 +629,7 @@ class ImageBoxerGUI(QMainWindow):
         
         # Add to layout
         self.preview_layout.addWidget(label, 0, 0)
+        self.preview_widget.setUpdatesEnabled(True)
 
     def save_mosaic(self):
         """Save the final mosaic image."""
@@ -402,7 +646,7 @@ class ImageBoxerGUI(QMainWindow):
         
         if file_path:
             try:
-                self.final_mosaic.save(file_path, quality=95)
+                img_boxer.save_image(self.final_mosaic, file_path, quality=95)
                 QMessageBox.information(self, "Success", "Mosaic saved successfully!")
             except Exception as e:
                 QMessageBox.critical(self, "Error", f"Error saving mosaic: {str(e)}")
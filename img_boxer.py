@@ -4,10 +4,38 @@ import argparse
 from pathlib import Path
 import glob
 from PIL import Image
+import numpy as np
 import os
 import math
-from typing import List, Tuple
+import hashlib
+import tempfile
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import List, Tuple, Union
 
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+    _turbojpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # PyTurboJPEG or the libturbojpeg shared library is missing
+    _turbojpeg = None
+
+# Base height of each mosaic cell (can be adjusted for higher/lower resolution)
+BASE_HEIGHT = 300
+
+# On-disk cache of resized mosaic cells, evicted least-recently-used first
+TILE_CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'img_boxer'
+TILE_CACHE_MAX_BYTES = 500 * 1024 * 1024
+# Temp files older than this were left behind by an interrupted write
+TILE_CACHE_TEMP_MAX_AGE = 60 * 60
+
+@functools.lru_cache(maxsize=128)
 def parse_aspect_ratio(ratio_str):
     """Convert aspect ratio string (e.g., '16:9') to float."""
     try:
@@ -16,46 +44,122 @@ def parse_aspect_ratio(ratio_str):
     except ValueError:
         raise argparse.ArgumentTypeError("Aspect ratio must be in format W:H (e.g., 16:9)")
 
-def resize_with_crop(image, target_ratio):
-    """Resize and crop image to match target aspect ratio."""
-    width, height = image.size
+def positive_int(value):
+    """Convert a command-line value to an integer of at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be a positive integer")
+    return number
+
+def non_negative_int(value):
+    """Convert a command-line value to an integer of at least 0."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise argparse.ArgumentTypeError("must be a non-negative integer")
+    return number
+
+def open_image(path, draft_size=None) -> Image.Image:
+    """Open an image file as RGB.
+
+    If draft_size is given, JPEGs are decoded at the smallest DCT scale
+    (1/2, 1/4 or 1/8) that is still at least draft_size.
+    """
+    img = Image.open(path)
+    try:
+        if draft_size and img.format == 'JPEG':
+            img.draft('RGB', draft_size)
+        if img.mode != 'RGB' or getattr(img, 'is_animated', False):
+            converted = img.convert('RGB')
+            img.close()
+            return converted
+        # Pillow closes the file once a single-frame image is loaded, so the
+        # decoded image can be returned without copying it
+        img.load()
+    except BaseException:
+        img.close()
+        raise
+    return img
+
+def _crop_box(width, height, target_ratio):
+    """Return the centred (left, top, right, bottom) box with the target aspect ratio."""
     current_ratio = width / height
 
     if current_ratio > target_ratio:
         # Image is too wide, crop width
         new_width = int(height * target_ratio)
         left = (width - new_width) // 2
-        return image.crop((left, 0, left + new_width, height))
+        return (left, 0, left + new_width, height)
     elif current_ratio < target_ratio:
         # Image is too tall, crop height
         new_height = int(width / target_ratio)
         top = (height - new_height) // 2
-        return image.crop((0, top, width, top + new_height))
-    return image
+        return (0, top, width, top + new_height)
+    return (0, 0, width, height)
 
-def resize_with_padding(image, target_ratio):
-    """Resize image to match target aspect ratio by adding padding."""
+def save_image(image: Image.Image, path, quality: int = 95):
+    """Save an image, encoding JPEGs with libjpeg-turbo when PyTurboJPEG is available."""
+    if (_turbojpeg is not None and image.mode == 'RGB'
+            and Path(path).suffix.lower() in ('.jpg', '.jpeg')):
+        data = _turbojpeg.encode(
+            np.asarray(image),
+            quality=quality,
+            pixel_format=TJPF_RGB,
+            jpeg_subsample=TJSAMP_420
+        )
+        with open(path, 'wb') as f:
+            f.write(data)
+    else:
+        image.save(path, quality=quality)
+
+def resize_with_crop(image, target_ratio):
+    """Resize and crop image to match target aspect ratio.
+
+    Used by the CLI; the mosaic crops inside the resize via _fit_to_cell.
+    """
+    box = _crop_box(*image.size, target_ratio)
+    if box == (0, 0) + image.size:
+        return image
+    return image.crop(box)
+
+def _resize_with_padding_array(image, target_ratio):
+    """Pad image to match target aspect ratio, returning an RGB NumPy array."""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
     width, height = image.size
     current_ratio = width / height
 
     if current_ratio > target_ratio:
         # Image is too wide, add vertical padding
-        new_height = int(width / target_ratio)
-        new_size = (width, new_height)
-        new_image = Image.new('RGB', new_size, (0, 0, 0))
-        paste_y = (new_height - height) // 2
-        new_image.paste(image, (0, paste_y))
-        return new_image
+        new_width, new_height = width, int(width / target_ratio)
     elif current_ratio < target_ratio:
         # Image is too tall, add horizontal padding
-        new_width = int(height * target_ratio)
-        new_size = (new_width, height)
-        new_image = Image.new('RGB', new_size, (0, 0, 0))
-        paste_x = (new_width - width) // 2
-        new_image.paste(image, (paste_x, 0))
-        return new_image
-    return image
+        new_width, new_height = int(height * target_ratio), height
+    else:
+        return np.asarray(image)
 
+    paste_x = (new_width - width) // 2
+    paste_y = (new_height - height) // 2
+    arr = np.zeros((new_height, new_width, 3), dtype=np.uint8)
+    arr[paste_y:paste_y + height, paste_x:paste_x + width] = np.asarray(image)
+    return arr
+
+def resize_with_padding(image, target_ratio):
+    """Resize image to match target aspect ratio by adding padding.
+
+    Used by the CLI; the mosaic leaves padding to its zero-filled buffer.
+    """
+    width, height = image.size
+    if width / height == target_ratio:
+        return image
+    return Image.fromarray(_resize_with_padding_array(image, target_ratio))
+
+@functools.lru_cache(maxsize=128)
 def calculate_grid_size(n: int) -> Tuple[int, int]:
     """Calculate the optimal grid size for n images."""
     if n <= 1:
@@ -66,77 +170,240 @@ def calculate_grid_size(n: int) -> Tuple[int, int]:
     rows = math.ceil(n / cols)
     return (rows, cols)
 
-def create_image_mosaic(images: List[Image.Image], target_ratio: float, crop_mode: bool = False) -> Image.Image:
-    """Create a mosaic of images that fits the target aspect ratio."""
-    if not images:
-        raise ValueError("No images provided")
-    
-    n_images = len(images)
-    rows, cols = calculate_grid_size(n_images)
-    
+def calculate_cell_size(n: int, target_ratio: float) -> Tuple[int, int, int, int]:
+    """Calculate the grid and cell size for a mosaic of n images.
+
+    Returns (rows, cols, cell_width, cell_height).
+    """
+    rows, cols = calculate_grid_size(n)
+
     # Calculate the size of each cell to maintain target ratio
     # If we have R rows and C columns, then:
     # (C * cell_width) / (R * cell_height) = target_ratio
     # Therefore: cell_width / cell_height = (target_ratio * R) / C
     cell_ratio = (target_ratio * rows) / cols
-    
-    # Base size for each cell (can be adjusted for higher/lower resolution)
-    BASE_HEIGHT = 300
+
     cell_height = BASE_HEIGHT
     cell_width = int(cell_height * cell_ratio)
+    return (rows, cols, cell_width, cell_height)
+
+def _fit_to_cell(image: Image.Image, cell_width: int, cell_height: int, crop_mode: bool) -> Image.Image:
+    """Resize an image to fit a mosaic cell.
+
+    In crop mode the result is exactly cell-sized. Otherwise the image is
+    scaled to fit inside the cell and the caller centres it, leaving the
+    padding to the zero-filled mosaic buffer.
+    """
+    # The mosaic buffer is RGB, so normalise the mode before resampling
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if crop_mode:
+        # Crop in the resampler's input space instead of allocating a cropped copy
+        box = _crop_box(*image.size, cell_width / cell_height)
+        return image.resize((cell_width, cell_height), Image.Resampling.LANCZOS, box=box)
     
-    # Create the final image
-    final_width = cell_width * cols
-    final_height = cell_height * rows
-    final_image = Image.new('RGB', (final_width, final_height), (0, 0, 0))
+    width, height = image.size
+    scale = min(cell_width / width, cell_height / height)
+    inner_size = (min(cell_width, max(1, round(width * scale))),
+                  min(cell_height, max(1, round(height * scale))))
+    return image.resize(inner_size, Image.Resampling.LANCZOS)
+
+def _tile_cache_path(path, cell_width: int, cell_height: int, crop_mode: bool) -> Path:
+    """Return the cache file for a source file resized to the given cell."""
+    abspath = os.path.abspath(path)
+    mtime_ns = os.stat(abspath).st_mtime_ns
+    key = f"{abspath}|{mtime_ns}|{cell_width}x{cell_height}|{crop_mode}"
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return TILE_CACHE_DIR / digest[:2] / f"{digest}.png"
+
+def _load_tile(source: Union[str, Image.Image], cell_width: int, cell_height: int,
+               crop_mode: bool, use_cache: bool) -> Image.Image:
+    """Return the resized tile for an image or an image file path."""
+    if isinstance(source, Image.Image):
+        return _fit_to_cell(source, cell_width, cell_height, crop_mode)
+    
+    cache_path = None
+    if use_cache:
+        try:
+            cache_path = _tile_cache_path(source, cell_width, cell_height, crop_mode)
+            tile = open_image(cache_path)
+            # Mark as recently used for LRU eviction
+            os.utime(cache_path)
+            return tile
+        except OSError:
+            pass
+    
+    img = open_image(source, (cell_width * 2, cell_height * 2))
+    tile = _fit_to_cell(img, cell_width, cell_height, crop_mode)
     
-    # Place each image in the grid
-    for idx, img in enumerate(images):
-        if idx >= rows * cols:
+    if cache_path is not None:
+        temp_path = None
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            # Unique temp name so concurrent writers of the same tile don't collide
+            fd, temp_path = tempfile.mkstemp(dir=cache_path.parent, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                tile.save(f, 'PNG', compress_level=1)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            if temp_path is not None:
+                try:
+                    os.unlink(temp_path)
+                except OSError:
+                    pass
+    return tile
+
+def prune_tile_cache(max_bytes: int = TILE_CACHE_MAX_BYTES):
+    """Delete the least recently used cached tiles until the cache fits in max_bytes.
+
+    Stale temp files from interrupted writes are deleted as well.
+    """
+    entries = []
+    total = 0
+    stale_before = time.time() - TILE_CACHE_TEMP_MAX_AGE
+    for cache_file in TILE_CACHE_DIR.glob('*/*'):
+        if cache_file.suffix not in ('.png', '.tmp'):
+            continue
+        try:
+            stat = cache_file.stat()
+            if cache_file.suffix == '.tmp':
+                if stat.st_mtime < stale_before:
+                    cache_file.unlink()
+                else:
+                    # Still being written; count it but leave it alone
+                    total += stat.st_size
+                continue
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, cache_file))
+        total += stat.st_size
+    
+    entries.sort()
+    for _, size, cache_file in entries:
+        if total <= max_bytes:
             break
-            
-        # Calculate position in grid
-        grid_row = idx // cols
-        grid_col = idx % cols
-        
-        # Resize image to fit cell
-        if crop_mode:
-            resized = resize_with_crop(img, cell_ratio)
-        else:
-            resized = resize_with_padding(img, cell_ratio)
+        try:
+            cache_file.unlink()
+            total -= size
+        except OSError:
+            pass
+
+def create_image_mosaic(images: List[Union[str, Image.Image]], target_ratio: float,
+                        crop_mode: bool = False, use_cache: bool = True) -> Image.Image:
+    """Create a mosaic of images that fits the target aspect ratio.
+
+    images may mix PIL images and image file paths. Tiles resized from
+    file paths are cached on disk unless use_cache is False.
+    """
+    if not images:
+        raise ValueError("No images provided")
+    
+    rows, cols, cell_width, cell_height = calculate_cell_size(len(images), target_ratio)
+    
+    # One zero-filled slot per grid cell; the zeros are the padding and the
+    # empty cells at the end of the last row
+    cells = np.zeros((rows * cols, cell_height, cell_width, 3), dtype=np.uint8)
+    
+    def place_tile(idx, source):
+        resized = _load_tile(source, cell_width, cell_height, crop_mode, use_cache)
+        # Centre tiles smaller than the cell
+        width, height = resized.size
+        x = (cell_width - width) // 2
+        y = (cell_height - height) // 2
+        cells[idx, y:y + height, x:x + width] = np.asarray(resized, dtype=np.uint8)
+    
+    # Load, resize and place every cell in parallel; Pillow releases the GIL
+    # while decoding and resampling, and each worker writes its own slot
+    sources = images[:rows * cols]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(place_tile, range(len(sources)), sources))
+    
+    if use_cache and any(not isinstance(source, Image.Image) for source in sources):
+        prune_tile_cache()
+    
+    # Lay the cells out as a grid in a single reshape/transpose
+    out = cells.reshape(rows, cols, cell_height, cell_width, 3)
+    out = out.transpose(0, 2, 1, 3, 4).reshape(rows * cell_height, cols * cell_width, 3)
+    return Image.fromarray(out)
+
+def create_image_mosaic_vips(paths: List[str], target_ratio: float, crop_mode: bool = False) -> Image.Image:
+    """Create a mosaic of image files using libvips.
+
+    Each cell is produced with pyvips.Image.thumbnail, which shrinks on load
+    for JPEG/WebP/TIFF instead of decoding the full image. Like the Pillow
+    path, EXIF orientation is ignored. This path does not use the on-disk
+    tile cache. Requires pyvips.
+
+    This path is best effort: it raises pyvips.Error for files this libvips
+    build can't load, and callers should fall back to create_image_mosaic.
+    """
+    if pyvips is None:
+        raise RuntimeError("pyvips is not installed")
+    if not paths:
+        raise ValueError("No images provided")
+    
+    rows, cols, cell_width, cell_height = calculate_cell_size(len(paths), target_ratio)
+    
+    tiles = []
+    for path in paths[:rows * cols]:
+        tile = pyvips.Image.thumbnail(
+            str(path), cell_width,
+            height=cell_height,
+            size='both',
+            crop='centre' if crop_mode else 'none',
+            # Match open_image, which does not apply EXIF orientation
+            no_rotate=True
+        )
         
-        # Resize to exact cell size
-        resized = resized.resize((cell_width, cell_height), Image.Resampling.LANCZOS)
+        # Normalise to 3-band sRGB, dropping any alpha onto black
+        if tile.interpretation not in ('srgb', 'rgb'):
+            tile = tile.colourspace('srgb')
+        if tile.hasalpha():
+            tile = tile.flatten(background=[0, 0, 0])
+        if tile.bands == 1:
+            tile = tile.bandjoin([tile, tile])
         
-        # Calculate position and paste
-        x = grid_col * cell_width
-        y = grid_row * cell_height
-        final_image.paste(resized, (x, y))
+        # Letterbox/pillarbox to the exact cell size
+        if tile.width != cell_width or tile.height != cell_height:
+            tile = tile.gravity('centre', cell_width, cell_height, extend='black')
+        tiles.append(tile.cast('uchar'))
     
-    return final_image
+    # Fill the remaining cells of the last row with black
+    while len(tiles) < rows * cols:
+        tiles.append(pyvips.Image.black(cell_width, cell_height, bands=3))
+    
+    mosaic = pyvips.Image.arrayjoin(tiles, across=cols)
+    return Image.frombytes('RGB', (mosaic.width, mosaic.height), mosaic.write_to_memory())
+
+def process_image(input_path, output_dir, target_ratio, crop_mode, max_dim=None):
+    """Process a single image.
 
-def process_image(input_path, output_dir, target_ratio, crop_mode):
-    """Process a single image."""
+    If max_dim is set, the image is first shrunk so its longer side is at
+    most max_dim pixels.
+    """
     try:
-        with Image.open(input_path) as img:
-            # Convert to RGB if necessary
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # Resize with either cropping or padding
-            if crop_mode:
-                result = resize_with_crop(img, target_ratio)
-            else:
-                result = resize_with_padding(img, target_ratio)
-            
-            # Create output filename
-            output_path = Path(output_dir) / f"processed_{Path(input_path).name}"
-            result.save(output_path, quality=95)
-            print(f"Processed: {input_path} -> {output_path}")
+        img = open_image(input_path, (max_dim, max_dim) if max_dim else None)
+        if max_dim and max(img.size) > max_dim:
+            img.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
+        
+        # Resize with either cropping or padding
+        if crop_mode:
+            result = resize_with_crop(img, target_ratio)
+        else:
+            result = resize_with_padding(img, target_ratio)
+        
+        # Create output filename
+        output_path = Path(output_dir) / f"processed_{Path(input_path).name}"
+        save_image(result, output_path, quality=95)
+        print(f"Processed: {input_path} -> {output_path}")
             
     except Exception as e:
         print(f"Error processing {input_path}: {str(e)}")
 
+def _process_image_job(job):
+    """Run process_image on an (input_path, output_dir, target_ratio, crop_mode, max_dim) tuple."""
+    process_image(*job)
+
 def main():
     parser = argparse.ArgumentParser(description="Resize images to match a target aspect ratio")
     parser.add_argument("--input", required=True, help="Input image path (supports glob patterns)")
@@ -146,6 +413,10 @@ def main():
                       help="Use cropping instead of padding to achieve target ratio")
     parser.add_argument("--output-dir", default="output",
                       help="Output directory for processed images")
+    parser.add_argument("--max-dim", type=non_negative_int, default=4096,
+                      help="Shrink images so the longer side is at most this many pixels (0 keeps full size)")
+    parser.add_argument("--jobs", type=positive_int, default=None,
+                      help="Number of worker processes (defaults to the CPU count, 1 runs serially)")
     
     args = parser.parse_args()
     
@@ -158,8 +429,19 @@ def main():
         print(f"No files found matching pattern: {args.input}")
         return
     
-    for input_file in input_files:
-        process_image(input_file, args.output_dir, args.aspect_ratio, args.crop)
+    jobs = [(input_file, args.output_dir, args.aspect_ratio, args.crop, args.max_dim)
+            for input_file in input_files]
+    if args.jobs == 1 or len(jobs) == 1:
+        for job in jobs:
+            _process_image_job(job)
+    else:
+        # Each file is independent, so spread them across processes. Use no
+        # more workers than files, and chunks small enough that every worker
+        # gets several
+        workers = min(args.jobs or os.cpu_count() or 1, len(jobs))
+        chunksize = max(1, len(jobs) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_process_image_job, jobs, chunksize=chunksize))
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file